@@ -1,8 +1,13 @@
 from typing import Optional, Tuple
 
+import os
 import pyvips
+import tifffile
+import numpy as np
 from wsitk_core import WSI
 from pathlib import Path
+from math import floor
+from tqdm import tqdm
 import configargparse as opt
 from datetime import datetime
 
@@ -20,11 +25,17 @@ def build_omexml(w: WSI,
     :param actual_bands: number of bands
     :return: the OME-XML description as a string.
     """
-    vendor = str(w._original_meta['openslide.vendor'])
-    dt = datetime.strptime(
-        w._original_meta[vendor + '.GENERAL.SLIDE_CREATIONDATETIME'],
-        '%d/%m/%Y %I:%M:%S',
-    )
+    meta = w._original_meta
+    vpfx = f"{meta.get('openslide.vendor', '')}.GENERAL."
+    camera_type = str(meta.get(vpfx + 'CAMERA_TYPE', ''))
+    objective_name = str(meta.get(vpfx + 'OBJECTIVE_NAME', ''))
+    objective_mag = str(meta.get(vpfx + 'OBJECTIVE_MAGNIFICATION', ''))
+    slide_id = str(meta.get(vpfx + 'SLIDE_ID', ''))
+    creation_dt = meta.get(vpfx + 'SLIDE_CREATIONDATETIME')
+    acquisition_date = ""
+    if creation_dt:
+        dt = datetime.strptime(str(creation_dt), '%d/%m/%Y %I:%M:%S')
+        acquisition_date = f"<AcquisitionDate>{dt.isoformat()}</AcquisitionDate>"
     if actual_width is None:
         actual_width = w.info['width']
     if actual_height is None:
@@ -35,22 +46,22 @@ def build_omexml(w: WSI,
     xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xsi:schemaLocation="http://www.openmicroscopy.org/Schemas/OME/2016-06 http://www.openmicroscopy.org/Schemas/OME/2016-06/ome.xsd">
     <Instrument ID="Instrument:0">
         <Detector ID="Detector:0:0" 
-                Model="{w._original_meta[vendor + '.GENERAL.CAMERA_TYPE']}"
+                Model="{camera_type}"
                 />
         <Objective ID="Objective:0:0" 
-                Model="{w._original_meta[vendor + '.GENERAL.OBJECTIVE_NAME']}" 
+                Model="{objective_name}" 
                 NominalMagnification="{mag}"
                 />
     </Instrument>
-    <Image ID="Image:0" Name="{w._original_meta[vendor + '.GENERAL.OBJECTIVE_MAGNIFICATION']}x">
-        <AcquisitionDate>{dt.isoformat()}</AcquisitionDate>
-        <Description>"{w._original_meta[vendor + '.GENERAL.SLIDE_ID']}"</Description>
+    <Image ID="Image:0" Name="{objective_mag}x">
+        {acquisition_date}
+        <Description>"{slide_id}"</Description>
         <InstrumentRef ID="Instrument:0"/>
         <ObjectiveSettings ID="Objective:0:0"/>
         <Pixels BigEndian="true" 
                 DimensionOrder="XYZCT" 
                 ID="Pixels:0" 
-                Interleaved="false" 
+                Interleaved="true" 
                 PhysicalSizeX="{w.info['mpp_x']}" 
                 PhysicalSizeXUnit="µm" 
                 PhysicalSizeY="{w.info['mpp_y']}" 
@@ -62,13 +73,7 @@ def build_omexml(w: WSI,
                 SizeY="{actual_height}" 
                 SizeZ="1" 
                 Type="uint8">
-            <Channel ID="Channel:0:0" SamplesPerPixel="1">
-                <LightPath/>
-            </Channel>
-            <Channel ID="Channel:0:1" SamplesPerPixel="1">
-                <LightPath/>
-            </Channel>
-            <Channel ID="Channel:0:2" SamplesPerPixel="1">
+            <Channel ID="Channel:0:0" SamplesPerPixel="{actual_bands}">
                 <LightPath/>
             </Channel>
             <MetadataOnly/>
@@ -77,50 +82,253 @@ def build_omexml(w: WSI,
 </OME>"""
     return o
 
-def wsi2ometiff(wsi_path, tiff_path, crop: Optional[Tuple[int,int,int,int]|bool]) -> None:
+def _ome_tiff_path(path) -> str:
     """
-    Converts a WSI file to OME-TIFF format.
+    Makes sure the destination file has an OME-TIFF suffix (readers such as Bio-Formats
+    select the OME-TIFF reader by file name): "x.tif"/"x.tiff" becomes "x.ome.tif" and
+    any other suffix gets ".ome.tif" appended.
 
-    :param wsi_path: source file path.
+    :param path: destination file path.
+    :return: the destination file path, with ".ome.tif"/".ome.tiff" suffix.
+    """
+    path = Path(path)
+    suffixes = "".join(path.suffixes[-2:]).lower()
+    if suffixes in (".ome.tif", ".ome.tiff"):
+        return str(path)
+    if path.suffix.lower() in (".tif", ".tiff"):
+        path = path.with_suffix("")
+
+    return str(path) + ".ome.tif"
+
+
+def _drop_page_cache(path) -> None:
+    """
+    Flushes a freshly written file to disk and advises the kernel to evict it from
+    the page cache (write-once data would otherwise displace more useful pages).
+    No-op on platforms without posix_fadvise().
+
+    :param path: file path.
+    :return: None
+    """
+    if not hasattr(os, "posix_fadvise"):
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)  # only clean pages can be dropped
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+    return
+
+
+def _first_tile(page: tifffile.TiffPage) -> Tuple[tuple, np.ndarray]:
+    """
+    Reads and decodes the first tile of a TIFF page.
+
+    :param page: a tiled TIFF page.
+    :return: (photometric, subsampling) tags of the page and the decoded tile.
+    """
+    fh = page.parent.filehandle
+    fh.seek(page.dataoffsets[0])
+    data = fh.read(page.databytecounts[0])
+    tile, _, _ = page.decode(data, 0, jpegtables=page.jpegtables)
+    subsampling = page.subsampling if page.photometric == tifffile.PHOTOMETRIC.YCBCR else None
+
+    return (page.photometric, subsampling), tile
+
+
+def _copy_svs_tiles(svs_path, tiff_path, description: str, tile_size: Optional[int]=None) -> bool:
+    """
+    Copies the JPEG tiles of an Aperio SVS pyramid, as they are (no decoding and
+    re-encoding), into a BigTIFF with the full resolution image in the main IFD
+    and the lower resolutions in its SubIFDs. The source tile size is kept.
+
+    :param svs_path: source file path.
     :param tiff_path: destination file path.
+    :param description: image description (OME-XML) for the main IFD.
+    :param tile_size: required tile size (None: any source tile size is accepted)
+    :return: True if the tiles were copied, False if the source does not allow it
+        or the copy does not read back as the source (no output is left in this case).
+    """
+    with tifffile.TiffFile(svs_path) as src:
+        if not src.is_svs:
+            return False
+        pages = [level.keyframe for level in src.series[0].levels]
+        for page in pages:
+            if not page.is_tiled or page.compression != tifffile.COMPRESSION.JPEG or \
+                    page.samplesperpixel != 3 or 0 in page.databytecounts:
+                return False
+            if tile_size is not None and (page.tilelength, page.tilewidth) != (tile_size, tile_size):
+                return False
+
+        with tifffile.TiffWriter(tiff_path, bigtiff=True) as dst:
+            for k, page in enumerate(pages):
+                tiles = (data for data, _ in
+                         src.filehandle.read_segments(page.dataoffsets, page.databytecounts))
+                # keep the source colour space and subsampling tags, they must match
+                # the (copied) JPEG streams; tifffile would otherwise tag RGB input
+                # as YCbCr 4:2:0
+                ycbcr = page.photometric == tifffile.PHOTOMETRIC.YCBCR
+                dst.write(tiles,
+                          shape=page.shape,
+                          dtype=page.dtype,
+                          tile=(page.tilelength, page.tilewidth),
+                          compression="jpeg",
+                          compressionargs={"outcolorspace": page.photometric},
+                          photometric=page.photometric,
+                          subsampling=page.subsampling if ycbcr else (1, 1),
+                          jpegtables=page.jpegtables,
+                          subifds=len(pages) - 1 if k == 0 else None,
+                          subfiletype=0 if k == 0 else 1,
+                          description=description if k == 0 else None,
+                          metadata=None)
+
+        # round-trip check: the first full resolution tile must read back with the
+        # same tags and pixels as in the source
+        with tifffile.TiffFile(tiff_path) as copy:
+            src_tags, src_tile = _first_tile(pages[0])
+            dst_tags, dst_tile = _first_tile(copy.pages[0])
+        if src_tags != dst_tags or not np.array_equal(src_tile, dst_tile):
+            os.remove(tiff_path)
+            return False
+
+    return True
+
+
+def _iter_tiles(im: pyvips.Image, tile_size: int):
+    """
+    Decodes an image band by band (on libvips' threadpool) and yields its tiles in
+    row-major order. Tiles at the right and bottom edges are cut at the image border
+    (tifffile pads them when encoding).
+
+    :param im: source image.
+    :param tile_size: width and height of the tiles.
+    :return: a generator of (at most) (tile_size, tile_size, bands) arrays.
+    """
+    for y in range(0, im.height, tile_size):
+        h = min(tile_size, im.height - y)
+        buf = im.crop(0, y, im.width, h).write_to_memory()
+        band = np.frombuffer(buf, dtype=np.uint8).reshape(h, im.width, im.bands)
+        for x in range(0, im.width, tile_size):
+            yield band[:, x : x + tile_size]
+
+
+# tile codecs: name in tifffile/imagecodecs and default quality ("level" argument of
+# the imagecodecs encoder: 0-100 quality for JPEG and WebP, target PSNR in dB for
+# JPEG-2000); WebP/JPEG-2000 give smaller tiles than JPEG at similar visual quality,
+# but fewer OME-TIFF readers support WebP
+TILE_COMPRESSION = {"jpeg": ("jpeg", 89), "jp2k": ("jpeg2000", 40), "webp": ("webp", 80)}
+
+
+def wsi2ometiff(wsi_path, tiff_path, crop: Optional[Tuple[int,int,int,int]|bool],
+                tile_size: Optional[int]=None,
+                compression: Optional[str]="jpeg",
+                quality: Optional[int]=None,
+                passthrough: Optional[bool]=True) -> str:
+    """
+    Converts a WSI file to OME-TIFF format. Each pyramid level of the WSI is copied
+    (as is, no resampling) to one IFD: level 0 in the main IFD, the others in its
+    SubIFDs.
+
+    :param wsi_path: source file path.
+    :param tiff_path: destination file path (".ome.tif" suffix is enforced).
     :param crop: either bool to control auto-crop or (x0, y0, width, height) for the crop region
+    :param tile_size: width and height of the TIFF tiles (default: 1024, or the source tile size
+        when the tiles are copied as they are)
+    :param compression: tile codec, one of TILE_COMPRESSION keys
+    :param quality: codec quality factor: 0-100 for jpeg and webp, target PSNR (dB) for jp2k
+        (default depends on codec)
+    :param passthrough: for uncropped Aperio SVS files and JPEG compression, copy the
+        source JPEG tiles as they are; only used when <quality> is not given and <tile_size>
+        is either not given or equal to the source tile size
 
-    :return: None
+    :return: the path of the written file (may differ from <tiff_path> by its suffix).
     """
+    tiff_path = _ome_tiff_path(tiff_path)
+    if compression not in TILE_COMPRESSION:
+        raise ValueError(f"unsupported compression: {compression}")
+
     wsi = WSI(Path(wsi_path))
 
+    if passthrough and compression == "jpeg" and quality is None and crop in (None, False) and \
+            wsi._original_meta.get('openslide.vendor') == 'aperio':
+        if _copy_svs_tiles(wsi_path, tiff_path, build_omexml(wsi), tile_size=tile_size):
+            _drop_page_cache(tiff_path)
+            return tiff_path
+
+    codec, default_quality = TILE_COMPRESSION[compression]
+    if quality is None:
+        quality = default_quality
+    if tile_size is None:
+        tile_size = 1024
+
+    # initially, whole image
+    x0, y0, width, height = (0, 0, wsi.info["width"], wsi.info["height"])
+
     if isinstance(crop, bool):
-        im = pyvips.Image.new_from_file(wsi_path, autocrop=crop)
+        if crop and wsi.info['roi'] is not None:
+            x0, y0, width, height = (wsi.info['roi']['x0'],
+                                     wsi.info['roi']['y0'],
+                                     wsi.info['roi']["width"],
+                                     wsi.info['roi']["height"])
     else:
-        if crop is None:
-            x0, y0, width, height = 0, 0, wsi.info["width"], wsi.info["height"]
-        else:
+        if crop is not None:
             x0, y0, width, height = crop
             x0 = max(0, min(x0, wsi.info["width"]))
             y0 = max(0, min(y0, wsi.info["height"]))
             width = min(width, wsi.info["width"] - x0)
             height = min(height, wsi.info["height"] - y0)
-        im = pyvips.Image.new_from_file(wsi_path, autocrop=False)
-        im = im.crop(x0, y0, width, height)
-
-    if im.hasalpha():
-        # alpha channel in 4th band, use for masking
-        im = im.flatten()
-
-    image_height = im.height
-    image_bands = im.bands
-    # split to separate image planes and stack vertically ready for OME
-    im = pyvips.Image.arrayjoin(im.bandsplit(), across=1)
-    im = im.copy()
-    im.set_type(pyvips.GValue.gint_type, "page-height", image_height)
-    im.set_type(pyvips.GValue.gstr_type, "image-description",
-                build_omexml(wsi, actual_width=im.width, actual_height=image_height, actual_bands=image_bands))
-
-    im.tiffsave(tiff_path, compression="jpeg", Q=89,
-                tile=True, bigtiff=True, subifd=True,
-                pyramid=True, tile_width=512, tile_height=512)
 
-    return
+    # built before the output is opened: metadata problems do not leave a truncated file behind
+    header = pyvips.Image.new_from_file(str(wsi_path), level=0, autocrop=False)
+    n_bands = header.bands - 1 if header.hasalpha() else header.bands
+    omexml = build_omexml(wsi, actual_width=int(floor(width)), actual_height=int(floor(height)),
+                          actual_bands=n_bands)
+    crop_regions = []
+    for i in range(wsi.level_count):
+        # -level i crop region:
+        cx0 = int(floor(x0 / wsi.downsample_factor(i)))
+        cy0 = int(floor(y0 / wsi.downsample_factor(i)))
+        cw = int(floor(width / wsi.downsample_factor(i)))
+        ch = int(floor(height / wsi.downsample_factor(i)))
+        if cw == 0 or ch == 0:
+            break  # (small) crop region vanishes at this level: stop the pyramid here
+        crop_regions.append((cx0, cy0, cw, ch))
+    if len(crop_regions) == 0:
+        raise ValueError("empty crop region")
+
+    with tifffile.TiffWriter(tiff_path, bigtiff=True) as dst:
+        for i, (cx0, cy0, cw, ch) in enumerate(tqdm(crop_regions, desc="Pyramid")):
+            im = pyvips.Image.new_from_file(str(wsi_path), level=i, autocrop=False, access="sequential")
+            im = im.crop(cx0, cy0, cw, ch)
+            if im.hasalpha():
+                # same as in wsi2zarr: the loader fills fully transparent pixels with the
+                # slide background colour and un-premultiplies the partially transparent
+                # ones (edges of downsampled levels), so their colour bands are usable as they
+                # are; dropping alpha avoids flatten()'s per-pixel blend (and its darkening
+                # of those edge pixels towards the black background)
+                im = im.extract_band(0, n=im.bands - 1)
+
+            assert im.bands == n_bands  # same as declared in the OME-XML
+            # a single interleaved RGB plane per IFD, described as such in the OME-XML;
+            # JPEG tiles are stored as YCbCr 4:2:0, like libvips/Aperio do
+            dst.write(_iter_tiles(im, tile_size),
+                      shape=(ch, cw, n_bands),
+                      dtype=np.uint8,
+                      tile=(tile_size, tile_size),
+                      photometric="ycbcr" if codec == "jpeg" else "rgb",
+                      subsampling=(2, 2) if codec == "jpeg" else None,
+                      compression=codec,
+                      compressionargs={"level": quality},
+                      subifds=len(crop_regions) - 1 if i == 0 else None,
+                      subfiletype=0 if i == 0 else 1,
+                      description=omexml if i == 0 else None,
+                      metadata=None,
+                      maxworkers=os.cpu_count())
+    _drop_page_cache(tiff_path)
+
+    return tiff_path
 
 
 if __name__ == "__main__":
@@ -132,9 +340,25 @@ if __name__ == "__main__":
                         """If <autocrop> is provided, <crop> is ignored.""")
     p.add_argument("--crop", action="store", help="region to crop (x0, y0, width, height in level-0 coordinates)",
                    nargs=4, type=int, required=False, default=None)
+    p.add_argument("--tile-size", action="store",
+                   help="size of the (square) TIFF tiles (default: 1024, or the source tile size if copied)",
+                   type=int, required=False, default=None)
+    p.add_argument("--compression", action="store", help="tile compression",
+                   choices=list(TILE_COMPRESSION.keys()), required=False, default="jpeg")
+    p.add_argument("--quality", action="store", help="compression quality: 0-100 for jpeg/webp, target PSNR (dB) for jp2k "
+                                                 "(default depends on codec)",
+                   type=int, required=False, default=None)
+    p.add_argument("--no-passthrough", action="store_true",
+                   help="always decode and re-encode the tiles, even if the source JPEG tiles could be copied")
 
     args = p.parse_args()
 
-    wsi2ometiff(args.input, args.output,
-                crop=True if args.autocrop else args.crop)
+    out_path = wsi2ometiff(args.input, args.output,
+                           crop=True if args.autocrop else args.crop,
+                           tile_size=args.tile_size,
+                           compression=args.compression,
+                           quality=args.quality,
+                           passthrough=not args.no_passthrough)
+    if out_path != args.output:
+        print(f"output written to {out_path}")
 # end
@@ -4,23 +4,104 @@ import configargparse as opt
 from wsitk_core import WSI
 from math import floor
 import zarr
-from tqdm import trange
+from zarr.codecs import BloscCodec
+from tqdm import tqdm
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+import multiprocessing as mp
 import pyvips
 import numpy as np
 
+
+def _read_band(im: pyvips.Image, y: int, height: int) -> np.ndarray:
+    """
+    Decodes a full-width horizontal band of an image (write_to_memory() runs the
+    decoding on libvips' threadpool).
+
+    :param im: source image.
+    :param y: top row of the band.
+    :param height: band height.
+    :return: the band as a read-only YXC array, viewing the libvips output buffer (no copy).
+    """
+    buf = im.crop(0, y, im.width, height).write_to_memory()
+    return np.frombuffer(buf, dtype=np.uint8).reshape(height, im.width, im.bands)
+
+
+def _write_level(
+        wsi_path: Path,
+        arr_path: Path,
+        level: int,
+        crop_region: Tuple[int,int,int,int],
+        band_size: int,
+        ram_budget: int,
+) -> None:
+    """
+    Copies (a region of) one pyramid level from a WSI into an existing Zarr array,
+    in one go if it fits in the RAM budget, band by band otherwise.
+
+    :param wsi_path: source file path.
+    :param arr_path: path of the destination Zarr array.
+    :param level: pyramid level to copy.
+    :param crop_region: (x0, y0, width, height) of the region to copy, in level coordinates
+    :param band_size: band height for processed regions (rounded up to a multiple of the shard height)
+    :param ram_budget: maximum size (bytes) of a level to be decoded at once
+    :return: None
+    """
+    cx0, cy0, cw, ch = crop_region
+
+    im = pyvips.Image.new_from_file(str(wsi_path), level=level, autocrop=False, access="sequential")
+    im = im.crop(cx0, cy0, cw, ch)
+    if im.hasalpha():
+        # same as in wsi2ometiff: the loader fills fully transparent pixels with the
+        # slide background colour and un-premultiplies the partially transparent ones,
+        # so the colour bands are kept as they are and only alpha is dropped
+        im = im.extract_band(0, n=im.bands - 1)
+
+    arr = zarr.open_array(str(arr_path), mode='r+')
+    if ch * cw * im.bands <= ram_budget:
+        # a single pass lets libvips spread the decoding over its whole threadpool
+        full = np.frombuffer(im.write_to_memory(), dtype=np.uint8).reshape(ch, cw, im.bands)
+        arr[:] = full.transpose(2, 0, 1)  # YXC -> CYX
+        return
+
+    # bands must cover whole rows of shards, otherwise each write triggers
+    # a read-modify-write of the partially filled shards; this way every
+    # shard is flushed exactly once:
+    shard_h = arr.shards[1]
+    level_band = max(1, -(-band_size // shard_h)) * shard_h
+    bands = [(y, min(level_band, ch - y)) for y in range(0, ch, level_band)]
+    # decoding the next band (libvips) overlaps with compressing/writing
+    # the current one (Zarr); at most two bands are held in memory
+    with ThreadPoolExecutor(max_workers=1) as reader:
+        next_buf = reader.submit(_read_band, im, *bands[0]) if bands else None
+        for j, (y, h) in enumerate(tqdm(bands, desc=f"Level {level}", position=level + 1, leave=False)):
+            buf = next_buf.result()
+            if j + 1 < len(bands):
+                next_buf = reader.submit(_read_band, im, *bands[j + 1])
+            arr[:, y : y + h] = buf.transpose(2, 0, 1)  # YXC -> CYX
+            del buf  # release the band before waiting for the next one
+
+    return
+
+
 def wsi2zarr(
         wsi_path: Union[str|Path],
         dst_path: Union[str|Path],
         crop: Optional[Tuple[int,int,int,int]|bool],
-        band_size: Optional[int]=1528,
+        band_size: Optional[int]=4096,
+        ram_budget: Optional[int]=2 * 1024**3,
 ) -> None:
     """
-    Converts a WSI file to pyramidal ZARR format.
+    Converts a WSI file to pyramidal ZARR (v3, sharded) format, with the levels stored
+    as CYX arrays and described by OME-NGFF multiscales metadata.
 
     :param wsi_path: source file path.
     :param dst_path: destination file path.
     :param crop: either bool to control auto-crop or (x0, y0, width, height) for the crop region
-    :param band_size: band height for processed regions
+    :param band_size: band height for processed regions (rounded up to a multiple of the shard height)
+    :param ram_budget: total memory (bytes) for levels decoded at once rather than band by band;
+        it is shared by the (up to 4) levels processed in parallel, so each of them gets
+        ram_budget / workers. Levels above that are copied by bands, keeping two bands
+        (2 x band_size x width x 3 bytes) in memory.
     :return: None
     """
     if not isinstance(wsi_path, Path):
@@ -51,44 +132,79 @@ def wsi2zarr(
 
     levels = np.zeros((2, wsi.level_count), dtype=np.int64)
 
-    with (zarr.open_group(str(dst_path/'pyramid_0.zarr'), mode='w') as root):
-        for i in trange(wsi.level_count, desc="Pyramid"):
-            # copy levels from WSI, band by band...
-            # -level i crop region:
-            cx0 = int(floor(x0 / wsi.downsample_factor(i)))
-            cy0 = int(floor(y0 / wsi.downsample_factor(i)))
-            cw = int(floor(width / wsi.downsample_factor(i)))
-            ch = int(floor(height / wsi.downsample_factor(i)))
-
-            im = pyvips.Image.new_from_file(str(wsi_path), level=i, autocrop=False)
-            im = im.crop(cx0, cy0, cw, ch)
-            im = im.flatten()
-
-            shape = (ch, cw, 3)  # YXC axes
-            levels[:, i] = (cw, ch)
-
-            arr = root.zeros('/'+str(i), shape=shape, chunks=(4096, 4096, None), dtype="uint8")
-            n_bands = ch // band_size
-            incomplete_band = shape[0] % band_size
-            for j in trange(n_bands, desc=f"Level {i}"):  # by horizontal bands
-                buf = im.crop(0, j * band_size, cw, band_size).numpy()
-                arr[j * band_size : (j + 1) * band_size] = buf
-                # arr[j * band_size:(j + 1) * band_size, ...] = \
-                #     wsi.get_region_px(cx0, cy0+j*band_size, cw, band_size, as_type=np.uint8)
-
-            if incomplete_band > 0:
-                buf = im.crop(0, n_bands * band_size, cw, incomplete_band).numpy()
-                arr[n_bands * band_size : n_bands * band_size + incomplete_band] = buf
-                # arr[n_bands * band_size: n_bands * band_size + incomplete_band, ...] = \
-                #     wsi.get_region_px(cx0, n_bands*band_size, cw, incomplete_band, as_type=np.uint8)
-        root.attrs["max_level"] = wsi.level_count
-        root.attrs["channel_names"] = ["R", "G", "B"]
-        root.attrs["dimension_names"] = ["y", "x", "c"]
-        root.attrs["mpp_x"] = wsi.info['mpp_x']
-        root.attrs["mpp_y"] = wsi.info["mpp_y"]
-        root.attrs["mag_step"] = int(wsi.info['magnification_step'])
-        root.attrs["objective_power"] = wsi.info['objective_power']
-        root.attrs["extent"] = levels.tolist()
+    root = zarr.open_group(str(dst_path/'pyramid_0.zarr'), mode='w', zarr_format=3)
+    crop_regions = []
+    for i in range(wsi.level_count):
+        # -level i crop region:
+        cx0 = int(floor(x0 / wsi.downsample_factor(i)))
+        cy0 = int(floor(y0 / wsi.downsample_factor(i)))
+        cw = int(floor(width / wsi.downsample_factor(i)))
+        ch = int(floor(height / wsi.downsample_factor(i)))
+        crop_regions.append((cx0, cy0, cw, ch))
+
+        shape = (3, ch, cw)  # CYX axes (channel before space, as OME-NGFF requires)
+        levels[:, i] = (cw, ch)
+
+        # 512x512 chunks (libvips' natural tile size) grouped in 4096x4096 shards,
+        # one file per shard instead of one per chunk; for 1-byte samples byte
+        # shuffle is a no-op, bit shuffle is what helps on natural images:
+        root.create_array(str(i), shape=shape, chunks=(3, 512, 512), shards=(3, 4096, 4096),
+                          dtype="uint8", dimension_names=("c", "y", "x"),
+                          compressors=BloscCodec(cname="zstd", clevel=3, shuffle="bitshuffle", typesize=1))
+
+    # OME-NGFF (v0.5, for Zarr v3) multiscales, for generic readers; built before
+    # writing the levels, and in pixel units if the slide has no resolution:
+    mpp_x, mpp_y = wsi.info.get('mpp_x'), wsi.info.get('mpp_y')
+    has_mpp = mpp_x is not None and mpp_y is not None
+    space_unit = {"unit": "micrometer"} if has_mpp else {}
+    ngff = {
+        "version": "0.5",
+        "multiscales": [{
+            "name": wsi_path.stem,
+            "axes": [
+                {"name": "c", "type": "channel"},
+                {"name": "y", "type": "space", **space_unit},
+                {"name": "x", "type": "space", **space_unit},
+            ],
+            "datasets": [
+                {
+                    "path": str(i),
+                    "coordinateTransformations": [{
+                        "type": "scale",
+                        "scale": [1.0,
+                                  (float(mpp_y) if has_mpp else 1.0) * wsi.downsample_factor(i),
+                                  (float(mpp_x) if has_mpp else 1.0) * wsi.downsample_factor(i)],
+                    }],
+                }
+                for i in range(wsi.level_count)
+            ],
+        }],
+    }
+
+    # levels are independent arrays (disjoint keys in the store), so they can
+    # be filled concurrently; "spawn" avoids forking an initialized libvips
+    n_workers = min(4, wsi.level_count)
+    with ProcessPoolExecutor(max_workers=n_workers,
+                             mp_context=mp.get_context("spawn")) as pool:
+        jobs = [pool.submit(_write_level, wsi_path, dst_path/'pyramid_0.zarr'/str(i), i, crop_regions[i],
+                            band_size, ram_budget // n_workers)
+                for i in range(wsi.level_count)]
+        for job in tqdm(as_completed(jobs), total=len(jobs), desc="Pyramid"):
+            job.result()
+
+    # single metadata write instead of one per attribute (attrs.update() would
+    # rewrite zarr.json once per key):
+    root.update_attributes({
+        "max_level": wsi.level_count,
+        "channel_names": ["R", "G", "B"],
+        "dimension_names": ["c", "y", "x"],
+        "mpp_x": mpp_x,
+        "mpp_y": mpp_y,
+        "mag_step": int(wsi.info['magnification_step']),
+        "objective_power": wsi.info['objective_power'],
+        "extent": levels.tolist(),
+        "ome": ngff,
+    })
 
     return
 